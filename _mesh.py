@@ -0,0 +1,375 @@
+import numpy as np
+import cv2
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Fixed size of the decorative border frame geometry
+FRAME_VERTEX_COUNT = 16
+FRAME_FACE_COUNT = 32
+
+# Border frame vertices as model-size and border-size coefficients:
+# outer top ring (0-3), inner top ring (4-7), outer bottom ring (8-11),
+# inner bottom ring (12-15), each ordered top-left, top-right,
+# bottom-right, bottom-left
+FRAME_MODEL_TEMPLATE = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]] * 4, dtype=np.float32)
+FRAME_BORDER_TEMPLATE = np.array([
+    [-1, -1, 1], [1, -1, 1], [1, 1, 1], [-1, 1, 1],
+    [0, 0, 1], [0, 0, 1], [0, 0, 1], [0, 0, 1],
+    [-1, -1, 0], [1, -1, 0], [1, 1, 0], [-1, 1, 0],
+    [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0],
+], dtype=np.float32)
+
+# Tile edge in pixels for the NumPy mesh builder, sized so a tile's
+# vertices (TILE * TILE * 3 * 4 bytes) fill about half of a typical L2
+MESH_TILE = 256
+
+def create_side_walls(faces, face_offset, rows, cols, row_offset):
+    """Add side walls to make the model solid and printable"""
+    
+    col = np.arange(cols - 1, dtype=np.int32)
+    row = np.arange(rows - 1, dtype=np.int32)
+
+    # Front wall
+    v1 = col
+    v2 = col + 1
+    b1 = row_offset + v1
+    b2 = row_offset + v2
+    front_wall = np.stack([
+        np.stack([v1, b1, v2], axis=-1),
+        np.stack([b1, b2, v2], axis=-1)
+    ], axis=1)
+    
+    # Back wall
+    v1 = (rows - 1) * cols + col
+    v2 = v1 + 1
+    b1 = row_offset + v1
+    b2 = row_offset + v2
+    back_wall = np.stack([
+        np.stack([v1, v2, b1], axis=-1),
+        np.stack([b1, v2, b2], axis=-1)
+    ], axis=1)
+    
+    # Left wall
+    v1 = row * cols
+    v2 = (row + 1) * cols
+    b1 = row_offset + v1
+    b2 = row_offset + v2
+    left_wall = np.stack([
+        np.stack([v1, v2, b1], axis=-1),
+        np.stack([b1, v2, b2], axis=-1)
+    ], axis=1)
+    
+    # Right wall
+    v1 = row * cols + (cols - 1)
+    v2 = (row + 1) * cols + (cols - 1)
+    b1 = row_offset + v1
+    b2 = row_offset + v2
+    right_wall = np.stack([
+        np.stack([v1, b1, v2], axis=-1),
+        np.stack([b1, b2, v2], axis=-1)
+    ], axis=1)
+
+    for wall in (front_wall, back_wall, left_wall, right_wall):
+        wall = wall.reshape(-1, 3)
+        faces[face_offset:face_offset + len(wall)] = wall
+        face_offset += len(wall)
+    return face_offset
+
+def add_border_frame(vertices, faces, vertex_offset, face_offset, rows, cols, 
+                     border_width, border_height, base_height, scale_x, scale_y):
+    """Add decorative border frame around the lithophane"""
+    
+    # Calculate actual model dimensions
+    model_width = (cols - 1) * scale_x
+    model_height = (rows - 1) * scale_y
+    
+    # Place the frame template: model corners scaled by the model size,
+    # pushed outwards and upwards by the border size
+    frame_vertices = (FRAME_MODEL_TEMPLATE * np.array([model_width, model_height, 0])
+                      + FRAME_BORDER_TEMPLATE * np.array([border_width, border_width, border_height]))
+    
+    vertices[vertex_offset:vertex_offset + FRAME_VERTEX_COUNT] = frame_vertices
+    base_idx = vertex_offset
+    
+    # Create faces for the border frame
+    i = np.arange(4, dtype=np.int32)
+    next_i = (i + 1) % 4
+    
+    # Top surface faces (between outer and inner border)
+    top = np.stack([
+        np.stack([i, next_i, i + 4], axis=-1),
+        np.stack([next_i, next_i + 4, i + 4], axis=-1)
+    ], axis=1)
+    
+    # Bottom surface faces
+    bottom = np.stack([
+        np.stack([i + 8, i + 12, next_i + 8], axis=-1),
+        np.stack([next_i + 8, i + 12, next_i + 12], axis=-1)
+    ], axis=1)
+    
+    # Outer wall faces
+    outer = np.stack([
+        np.stack([i, i + 8, next_i], axis=-1),
+        np.stack([next_i, i + 8, next_i + 8], axis=-1)
+    ], axis=1)
+    
+    # Inner wall faces
+    inner = np.stack([
+        np.stack([i + 4, next_i + 4, i + 12], axis=-1),
+        np.stack([next_i + 4, next_i + 12, i + 12], axis=-1)
+    ], axis=1)
+    
+    frame_faces = base_idx + np.concatenate([
+        top.reshape(-1, 3),
+        bottom.reshape(-1, 3),
+        outer.reshape(-1, 3),
+        inner.reshape(-1, 3)
+    ])
+    
+    faces[face_offset:face_offset + FRAME_FACE_COUNT] = frame_faces
+    return vertex_offset + FRAME_VERTEX_COUNT, face_offset + FRAME_FACE_COUNT
+
+def _fill_surface_vertices(thicknesses, scale_x, scale_y, vertices, ry0, ry1, rx0, rx1):
+    """Fill the front and back vertices of one image block"""
+    rows, cols = thicknesses.shape
+
+    # Grid-shaped views into the preallocated array
+    front = vertices[:rows * cols].reshape(rows, cols, 3)
+    back = vertices[rows * cols:2 * rows * cols].reshape(rows, cols, 3)
+
+    # Grid coordinates shared by the front and back surfaces
+    xs = np.arange(rx0, rx1) * scale_x
+    ys = np.arange(ry0, ry1) * scale_y
+
+    # Front vertices, then the flat back
+    front[ry0:ry1, rx0:rx1, 0] = xs
+    front[ry0:ry1, rx0:rx1, 1] = ys[:, None]
+    front[ry0:ry1, rx0:rx1, 2] = thicknesses[ry0:ry1, rx0:rx1]
+    back[ry0:ry1, rx0:rx1, 0] = xs
+    back[ry0:ry1, rx0:rx1, 1] = ys[:, None]
+    back[ry0:ry1, rx0:rx1, 2] = 0
+
+def _build_surface_tile(thicknesses, scale_x, scale_y, vertices, faces, ry0, ry1, rx0, rx1):
+    """Fill the vertices and interior faces of one image tile using NumPy broadcasting"""
+    rows, cols = thicknesses.shape
+    _fill_surface_vertices(thicknesses, scale_x, scale_y, vertices, ry0, ry1, rx0, rx1)
+
+    # Grid-shaped view into the preallocated faces
+    cells = faces[:4 * (rows - 1) * (cols - 1)].reshape(rows - 1, cols - 1, 4, 3)
+
+    # The last row and column have no cells beyond them
+    cy1 = min(ry1, rows - 1)
+    cx1 = min(rx1, cols - 1)
+    if cy1 <= ry0 or cx1 <= rx0:
+        return
+
+    # Corner indices of every grid cell
+    r = np.arange(ry0, cy1, dtype=np.int32)[:, None]
+    c = np.arange(rx0, cx1, dtype=np.int32)
+    v1 = r * cols + c
+    v2 = v1 + 1
+    v3 = v1 + cols
+    v4 = v3 + 1
+
+    b1 = v1 + rows * cols
+    b2 = v2 + rows * cols
+    b3 = v3 + rows * cols
+    b4 = v4 + rows * cols
+
+    front_tris = np.stack([v1, v2, v3], axis=-1)
+    front_tris2 = np.stack([v2, v4, v3], axis=-1)
+    back_tris = np.stack([b1, b3, b2], axis=-1)
+    back_tris2 = np.stack([b2, b3, b4], axis=-1)
+
+    # Interleave so each cell keeps its four triangles together
+    cells[ry0:cy1, rx0:cx1] = np.stack([front_tris, front_tris2, back_tris, back_tris2], axis=2)
+
+def _build_surface_rows(thicknesses, scale_x, scale_y, vertices, faces, row_start, row_stop):
+    """Fill rows [row_start, row_stop) tile by tile so each tile's working set stays in cache"""
+    cols = thicknesses.shape[1]
+    for ry in range(row_start, row_stop, MESH_TILE):
+        for rx in range(0, cols, MESH_TILE):
+            _build_surface_tile(thicknesses, scale_x, scale_y, vertices, faces,
+                                ry, min(ry + MESH_TILE, row_stop), rx, min(rx + MESH_TILE, cols))
+
+def _build_surface_mesh_numpy(thicknesses, scale_x, scale_y, vertices, faces):
+    """Fill the front/back vertices and interior faces, splitting the rows across a thread pool"""
+    rows = thicknesses.shape[0]
+    n_jobs = os.cpu_count() or 1
+    chunk = -(-rows // n_jobs)
+    
+    # Chunks write disjoint slices, so no locking is needed
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        jobs = [pool.submit(_build_surface_rows, thicknesses, scale_x, scale_y,
+                            vertices, faces, start, min(start + chunk, rows))
+                for start in range(0, rows, chunk)]
+        for job in jobs:
+            job.result()
+
+def _build_surface_mesh_numba(thicknesses, scale_x, scale_y, vertices, faces):
+    """Fill the front/back vertices and interior faces in one parallel pass over the rows"""
+    rows, cols = thicknesses.shape
+    back_offset = rows * cols
+    
+    for row in prange(rows):
+        for col in range(cols):
+            v = row * cols + col
+            x = col * scale_x
+            y = row * scale_y
+            vertices[v, 0] = x
+            vertices[v, 1] = y
+            vertices[v, 2] = thicknesses[row, col]
+            vertices[back_offset + v, 0] = x
+            vertices[back_offset + v, 1] = y
+            vertices[back_offset + v, 2] = 0
+        
+        if row < rows - 1:
+            for col in range(cols - 1):
+                v1 = row * cols + col
+                v2 = v1 + 1
+                v3 = v1 + cols
+                v4 = v3 + 1
+                f = 4 * (row * (cols - 1) + col)
+                
+                faces[f, 0] = v1
+                faces[f, 1] = v2
+                faces[f, 2] = v3
+                faces[f + 1, 0] = v2
+                faces[f + 1, 1] = v4
+                faces[f + 1, 2] = v3
+                faces[f + 2, 0] = back_offset + v1
+                faces[f + 2, 1] = back_offset + v3
+                faces[f + 2, 2] = back_offset + v2
+                faces[f + 3, 0] = back_offset + v2
+                faces[f + 3, 1] = back_offset + v3
+                faces[f + 3, 2] = back_offset + v4
+
+# Use the compiled kernel when numba is installed, NumPy otherwise
+if NUMBA_AVAILABLE:
+    build_surface_mesh = njit(parallel=True, cache=True)(_build_surface_mesh_numba)
+else:
+    build_surface_mesh = _build_surface_mesh_numpy
+
+def _perimeter_offsets(size):
+    """(dy, dx) steps around a size x size block: down the left edge, along the bottom, up the right edge, back along the top"""
+    t = np.arange(size, dtype=np.int32)
+    edge = np.full(size, size, dtype=np.int32)
+    zero = np.zeros(size, dtype=np.int32)
+    dy = np.concatenate([t, edge, size - t, zero])
+    dx = np.concatenate([zero, t, edge, size - t])
+    return dy, dx
+
+def _flat_block_levels(thicknesses, flat_tolerance):
+    """Merge grid cells bottom-up into aligned power-of-two blocks whose thickness spread is within tolerance"""
+    rows, cols = thicknesses.shape
+    total, sq_total = cv2.integral2(thicknesses, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    limit = flat_tolerance ** 2
+    
+    # Every cell is trivially flat; level k holds blocks of 2**k cells a side
+    levels = [np.ones((rows - 1, cols - 1), dtype=bool)]
+    size = 1
+    while True:
+        size *= 2
+        n_y, n_x = (rows - 1) // size, (cols - 1) // size
+        if n_y == 0 or n_x == 0:
+            break
+        children = levels[-1][:2 * n_y, :2 * n_x].reshape(n_y, 2, n_x, 2).all(axis=(1, 3))
+        
+        # Variance of the (size + 1)^2 pixels under each block in O(1) from the integral images
+        y0 = (np.arange(n_y) * size)[:, None]
+        x0 = np.arange(n_x) * size
+        y1 = y0 + size + 1
+        x1 = x0 + size + 1
+        n = (size + 1) ** 2
+        mean = (total[y1, x1] - total[y0, x1] - total[y1, x0] + total[y0, x0]) / n
+        mean_sq = (sq_total[y1, x1] - sq_total[y0, x1] - sq_total[y1, x0] + sq_total[y0, x0]) / n
+        
+        level = children & (mean_sq - mean ** 2 < limit)
+        if not level.any():
+            break
+        levels.append(level)
+    return levels
+
+def build_adaptive_surface(thicknesses, scale_x, scale_y, vertices, flat_tolerance):
+    """
+    Fill the front/back vertices and return front/back faces that cover flat
+    regions with large quads instead of one quad per pixel.
+    
+    Quads whose edges carry vertices of smaller neighbours are fanned around
+    their centre so the surface has no T-junction cracks. Image boundary
+    vertices are always kept so create_side_walls can close the model.
+    """
+    rows, cols = thicknesses.shape
+    _fill_surface_vertices(thicknesses, scale_x, scale_y, vertices, 0, rows, 0, cols)
+    levels = _flat_block_levels(thicknesses, flat_tolerance)
+    
+    # Leaves are merged blocks whose parent block did not merge
+    leaves = []
+    for k, level in enumerate(levels):
+        leaf = level.copy()
+        if k + 1 < len(levels):
+            parent = levels[k + 1].repeat(2, axis=0).repeat(2, axis=1)
+            leaf[:parent.shape[0], :parent.shape[1]] &= ~parent
+        by, bx = np.nonzero(leaf)
+        leaves.append((2 ** k, (by * 2 ** k).astype(np.int32), (bx * 2 ** k).astype(np.int32)))
+    
+    # Vertices used by any quad corner, plus the image boundary
+    active = np.zeros((rows, cols), dtype=bool)
+    active[[0, -1], :] = True
+    active[:, [0, -1]] = True
+    for size, y0, x0 in leaves:
+        active[y0, x0] = True
+        active[y0 + size, x0] = True
+        active[y0, x0 + size] = True
+        active[y0 + size, x0 + size] = True
+    
+    front_faces = []
+    for size, y0, x0 in leaves:
+        if len(y0) == 0:
+            continue
+        dy, dx = _perimeter_offsets(size)
+        py = y0[:, None] + dy
+        px = x0[:, None] + dx
+        on = active[py, px]
+        idx = py * cols + px
+        
+        # Plain quads split the same way as single cells
+        simple = on.sum(axis=1) == 4
+        v1 = idx[simple, 0]
+        v3 = idx[simple, size]
+        v4 = idx[simple, 2 * size]
+        v2 = idx[simple, 3 * size]
+        front_faces.append(np.stack([
+            np.stack([v1, v2, v3], axis=-1),
+            np.stack([v2, v4, v3], axis=-1)
+        ], axis=1).reshape(-1, 3))
+        
+        if simple.all():
+            continue
+        
+        # Fan the rest from their centre through every active perimeter vertex
+        on = on[~simple]
+        idx = idx[~simple]
+        centre = (y0[~simple] + size // 2) * cols + x0[~simple] + size // 2
+        p = 4 * size
+        pos = np.where(np.concatenate([on, on], axis=1), np.arange(2 * p), 2 * p)
+        next_on = np.minimum.accumulate(pos[:, ::-1], axis=1)[:, ::-1][:, 1:p + 1] % p
+        leaf, j = np.nonzero(on)
+        front_faces.append(np.stack([centre[leaf], idx[leaf, next_on[leaf, j]], idx[leaf, j]], axis=-1))
+    
+    front_faces = np.concatenate(front_faces).astype(np.int32)
+    back_faces = front_faces[:, [0, 2, 1]] + rows * cols
+    return np.concatenate([front_faces, back_faces])
+
+def remove_unused_vertices(vertices, faces):
+    """Drop vertices no face refers to and renumber the faces"""
+    used = np.zeros(len(vertices), dtype=bool)
+    used[faces] = True
+    remap = (np.cumsum(used) - 1).astype(np.int32)
+    return vertices[used], remap[faces]
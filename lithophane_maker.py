@@ -1,157 +1,116 @@
 import numpy as np
 from PIL import Image
-from stl import mesh
 import cv2
 import argparse
 from tqdm import tqdm
 import os
 from pathlib import Path
 import sys
+import json
+import io
+import zipfile
+from _mesh import (FRAME_VERTEX_COUNT, FRAME_FACE_COUNT, create_side_walls,
+                   add_border_frame, build_surface_mesh, build_adaptive_surface,
+                   remove_unused_vertices)
 
-def create_side_walls(vertices, faces, rows, cols, row_offset):
-    """Add side walls to make the model solid and printable"""
-    
-    # Front wall
-    for col in range(cols - 1):
-        v1 = col
-        v2 = col + 1
-        b1 = row_offset + col
-        b2 = row_offset + col + 1
-        faces.extend([
-            [v1, v2, b1],
-            [b1, v2, b2]
-        ])
-    
-    # Back wall
-    for col in range(cols - 1):
-        v1 = (rows - 1) * cols + col
-        v2 = (rows - 1) * cols + col + 1
-        b1 = row_offset + (rows - 1) * cols + col
-        b2 = row_offset + (rows - 1) * cols + col + 1
-        faces.extend([
-            [v1, b1, v2],
-            [b1, b2, v2]
-        ])
-    
-    # Left wall
-    for row in range(rows - 1):
-        v1 = row * cols
-        v2 = (row + 1) * cols
-        b1 = row_offset + row * cols
-        b2 = row_offset + (row + 1) * cols
-        faces.extend([
-            [v1, b1, v2],
-            [b1, b2, v2]
-        ])
-    
-    # Right wall
-    for row in range(rows - 1):
-        v1 = row * cols + (cols - 1)
-        v2 = (row + 1) * cols + (cols - 1)
-        b1 = row_offset + row * cols + (cols - 1)
-        b2 = row_offset + (row + 1) * cols + (cols - 1)
-        faces.extend([
-            [v1, v2, b1],
-            [b1, v2, b2]
-        ])
-    return faces
+# Supported values for create_lithophane's output_format
+OUTPUT_FORMATS = ('stl', '3mf', 'heightmap')
 
-def add_border_frame(vertices, faces, rows, cols, border_width, border_height, base_height, scale_x, scale_y):
-    """Add decorative border frame around the lithophane"""
-    original_vertex_count = len(vertices)
-    
-    # Calculate actual model dimensions
-    model_width = (cols - 1) * scale_x
-    model_height = (rows - 1) * scale_y
-    
-    # Add frame vertices
-    frame_vertices = []
-    
-    # Create vertices for a full border frame
-    # Top face vertices
-    frame_vertices.extend([
-        [-border_width, -border_width, border_height],  # Top-left (0)
-        [model_width + border_width, -border_width, border_height],  # Top-right (1)
-        [model_width + border_width, model_height + border_width, border_height],  # Bottom-right (2)
-        [-border_width, model_height + border_width, border_height],  # Bottom-left (3)
-        
-        # Inner top vertices
-        [0, 0, border_height],  # Inner top-left (4)
-        [model_width, 0, border_height],  # Inner top-right (5)
-        [model_width, model_height, border_height],  # Inner bottom-right (6)
-        [0, model_height, border_height],  # Inner bottom-left (7)
-    ])
-    
-    # Bottom face vertices
-    frame_vertices.extend([
-        [-border_width, -border_width, 0],  # Bottom face top-left (8)
-        [model_width + border_width, -border_width, 0],  # Bottom face top-right (9)
-        [model_width + border_width, model_height + border_width, 0],  # Bottom face bottom-right (10)
-        [-border_width, model_height + border_width, 0],  # Bottom face bottom-left (11)
-        
-        # Inner bottom vertices
-        [0, 0, 0],  # Inner bottom top-left (12)
-        [model_width, 0, 0],  # Inner bottom top-right (13)
-        [model_width, model_height, 0],  # Inner bottom bottom-right (14)
-        [0, model_height, 0],  # Inner bottom bottom-left (15)
-    ])
-    
-    vertices.extend(frame_vertices)
-    base_idx = original_vertex_count
-    
-    # Create faces for the border frame
-    frame_faces = []
-    
-    # Top surface faces (between outer and inner border)
-    for i in range(4):
-        next_i = (i + 1) % 4
-        inner_i = i + 4
-        inner_next = ((i + 1) % 4) + 4
-        
-        frame_faces.extend([
-            [base_idx + i, base_idx + next_i, base_idx + inner_i],
-            [base_idx + next_i, base_idx + inner_next, base_idx + inner_i]
-        ])
-    
-    # Bottom surface faces
-    for i in range(4):
-        next_i = (i + 1) % 4
-        inner_i = i + 12
-        inner_next = ((i + 1) % 4) + 12
+def compute_face_normals(tris):
+    """Unit normals for an (N, 3, 3) triangle array in one vectorized pass, zero for degenerate triangles"""
+    e1 = tris[:, 1] - tris[:, 0]
+    e2 = tris[:, 2] - tris[:, 0]
+    normals = np.cross(e1, e2)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True).clip(1e-12)
+    return normals
+
+def save_binary_stl(output_path, vertices, faces):
+    """Write an indexed mesh straight to a binary STL file"""
+    tris = vertices[faces].astype('<f4')
+    normals = compute_face_normals(tris)
+    
+    record = np.dtype([('n', '<f4', 3), ('v', '<f4', (3, 3)), ('attr', '<u2')])
+    rec = np.zeros(len(tris), dtype=record)
+    rec['n'] = normals
+    rec['v'] = tris
+    
+    with open(output_path, 'wb') as f:
+        f.write(b'\0' * 80)
+        f.write(np.uint32(len(rec)).tobytes())
+        f.write(rec.tobytes())
+
+def save_3mf(output_path, vertices, faces):
+    """Write an indexed mesh to a 3MF package, sharing vertices between triangles"""
+    model_path = Path(output_path).with_suffix('.3mf')
+    
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+        '</Types>'
+    )
+    rels = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Target="/3D/3dmodel.model" Id="rel0" '
+        'Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+        '</Relationships>'
+    )
+    
+    with zipfile.ZipFile(model_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', content_types)
+        zf.writestr('_rels/.rels', rels)
         
-        frame_faces.extend([
-            [base_idx + i + 8, base_idx + inner_i, base_idx + next_i + 8],
-            [base_idx + next_i + 8, base_idx + inner_i, base_idx + inner_next]
-        ])
-    
-    # Outer wall faces
-    for i in range(4):
-        next_i = (i + 1) % 4
-        frame_faces.extend([
-            [base_idx + i, base_idx + i + 8, base_idx + next_i],
-            [base_idx + next_i, base_idx + i + 8, base_idx + next_i + 8]
-        ])
-    
-    # Inner wall faces
-    for i in range(4):
-        next_i = (i + 1) % 4
-        frame_faces.extend([
-            [base_idx + i + 4, base_idx + next_i + 4, base_idx + i + 12],
-            [base_idx + next_i + 4, base_idx + next_i + 12, base_idx + i + 12]
-        ])
-    
-    faces.extend(frame_faces)
-    return vertices, faces
+        # Stream the vertex and triangle lists straight into the archive
+        with zf.open('3D/3dmodel.model', 'w') as raw:
+            f = io.TextIOWrapper(raw, encoding='utf-8')
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<model unit="millimeter" xml:lang="en-US" '
+                    'xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n'
+                    '<resources><object id="1" type="model"><mesh>\n<vertices>\n')
+            np.savetxt(f, vertices, fmt='<vertex x="%.4f" y="%.4f" z="%.4f"/>')
+            f.write('</vertices>\n<triangles>\n')
+            np.savetxt(f, faces, fmt='<triangle v1="%d" v2="%d" v3="%d"/>')
+            f.write('</triangles>\n</mesh></object></resources>\n'
+                    '<build><item objectid="1"/></build>\n</model>\n')
+            f.flush()
+            f.detach()
+    return model_path
+
+def save_heightmap(output_path, thicknesses, metadata, image_path):
+    """Write the thickness map as a 16-bit PNG plus a JSON sidecar describing how to rebuild the mesh"""
+    output_path = Path(output_path)
+    png_path = output_path.with_name(f"{output_path.stem}_heightmap.png")
+    json_path = output_path.with_name(f"{output_path.stem}_heightmap.json")
+    
+    # Never write over the source image
+    for path in (png_path, json_path):
+        if path.exists() and os.path.samefile(path, image_path):
+            raise ValueError(f"Refusing to overwrite the input image: {path}")
+    
+    # Spread [min_thickness, max_thickness] over the full 16-bit range
+    min_thickness = metadata['min_thickness']
+    span = (metadata['max_thickness'] - min_thickness) or 1.0
+    levels = np.rint((thicknesses - min_thickness) * (65535.0 / span))
+    heightmap = np.clip(levels, 0, 65535).astype(np.uint16)
+    
+    if not cv2.imwrite(str(png_path), heightmap):
+        raise RuntimeError(f"Could not write height map: {png_path}")
+    with open(json_path, 'w') as f:
+        json.dump(dict(metadata, heightmap=png_path.name), f, indent=2)
+    return png_path, json_path
 
 def create_lithophane(image_path, output_path, max_thickness=3.0, min_thickness=0.6, 
                      width=100, smoothing=True, border=False, border_width=5, 
-                     border_height=5, invert=False):
+                     border_height=5, invert=False, output_format='stl',
+                     adaptive_mesh=False, flat_tolerance=0.01):
     """
     Convert an image to a lithophane STL with enhanced features.
     
     Args:
         image_path (str): Path to input image
-        output_path (str): Path for output STL file
+        output_path (str): Path for output file
         max_thickness (float): Maximum thickness in mm (darker areas)
         min_thickness (float): Minimum thickness in mm (lighter areas)
         width (int): Desired width in mm
@@ -160,16 +119,23 @@ def create_lithophane(image_path, output_path, max_thickness=3.0, min_thickness=
         border_width (float): Width of border in mm
         border_height (float): Height of border in mm
         invert (bool): Invert the thickness mapping
+        output_format (str): 'stl' or '3mf' for a mesh, 'heightmap' for a 16-bit PNG plus JSON metadata
+        adaptive_mesh (bool): Merge flat regions into larger quads to reduce the triangle count
+        flat_tolerance (float): Maximum thickness standard deviation in mm for a region to be merged
     """
     # Validate input file
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image file not found: {image_path}")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
     
     # Create output directory if it doesn't exist
     output_dir = os.path.dirname(os.path.abspath(output_path))
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
     print("Loading and processing image...")
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(os.cpu_count() or 1)
     img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
     if img is None:
         raise ValueError("Could not read image - file may be corrupted")
@@ -179,88 +145,109 @@ def create_lithophane(image_path, output_path, max_thickness=3.0, min_thickness=
     new_width = int(width / 0.2)
     new_height = int(new_width / aspect_ratio)
     
+    # Halve large images with pyrDown until within 2x of the target, then finish with INTER_AREA
+    while img.shape[1] >= 2 * new_width and img.shape[0] >= 2 * new_height:
+        img = cv2.pyrDown(img)
+    
     # Resize image
     img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
         
     if smoothing:
         img = cv2.GaussianBlur(img, (3, 3), 0)
 
+    # Map pixel values to thickness in one lookup pass (darker is thicker unless inverted)
+    levels = np.arange(256, dtype=np.float32)
     if not invert:
-        img = 255 - img
-    
-    # Convert pixel values to thickness
-    thicknesses = (img.astype(float) / 255.0) * (max_thickness - min_thickness) + min_thickness
+        levels = 255 - levels
+    lut = levels * np.float32((max_thickness - min_thickness) / 255.0) + np.float32(min_thickness)
+    thicknesses = cv2.LUT(img, lut)
     
-    # Initialize progress bar
-    total_steps = new_height * new_width * 2
-    pbar = tqdm(total=total_steps, desc="Generating 3D mesh")
-
     # Create vertices and faces
     rows, cols = thicknesses.shape
-    vertices = []
-    faces = []
     
     # Scale factors
     scale_x = width / (cols - 1)
     scale_y = (width / aspect_ratio) / (rows - 1)
 
-    # Create vertices for flat lithophane
-    for row in range(rows):
-        for col in range(cols):
-            vertices.append([col * scale_x, row * scale_y, thicknesses[row, col]])
-            pbar.update(1)
+    # The grid and thickness range fully describe the mesh, so skip building it
+    if output_format == 'heightmap':
+        png_path, json_path = save_heightmap(output_path, thicknesses, {
+            'scale_x': scale_x,
+            'scale_y': scale_y,
+            'min_thickness': min_thickness,
+            'max_thickness': max_thickness,
+            'width': width,
+            'aspect_ratio': aspect_ratio,
+            'border': border,
+            'border_width': border_width,
+            'border_height': border_height
+        }, image_path)
+        print(f"Height map creation complete!")
+        print(f"Output files: {png_path}, {json_path}")
+        print(f"Model dimensions: {width}mm x {width/aspect_ratio:.1f}mm")
+        print(f"Thickness range: {min_thickness}mm to {max_thickness}mm")
+        return
 
-    # Create back vertices
-    for row in range(rows):
-        for col in range(cols):
-            vertices.append([col * scale_x, row * scale_y, 0])
-            pbar.update(1)
-    pbar.set_description("Creating faces")
+    # Initialize progress bar, advanced once per stage
+    total_steps = 4 if border else 3
+    pbar = tqdm(total=total_steps, desc="Generating 3D mesh")
+
+    # Preallocate the full mesh so every stage writes into its own slice
+    n_vert = 2 * rows * cols
+    if border:
+        n_vert += FRAME_VERTEX_COUNT
+    if n_vert >= 2**31:
+        raise ValueError("Image too large - vertex indices would overflow int32, reduce the width")
+    vertices = np.empty((n_vert, 3), dtype=np.float32)
 
-    for row in range(rows - 1):
-        for col in range(cols - 1):
-            v1 = row * cols + col
-            v2 = row * cols + (col + 1)
-            v3 = (row + 1) * cols + col
-            v4 = (row + 1) * cols + (col + 1)
-            
-            faces.append([v1, v3, v2])
-            faces.append([v2, v3, v4])
-            
-            b1 = rows * cols + row * cols + col
-            b2 = rows * cols + row * cols + (col + 1)
-            b3 = rows * cols + (row + 1) * cols + col
-            b4 = rows * cols + (row + 1) * cols + (col + 1)
-            
-            faces.append([b1, b2, b3])
-            faces.append([b2, b4, b3])
+    # Create front/back vertices and the faces between them
+    if adaptive_mesh:
+        surface_faces = build_adaptive_surface(thicknesses, scale_x, scale_y, vertices, flat_tolerance)
+        n_surface = len(surface_faces)
+    else:
+        n_surface = 4 * (rows - 1) * (cols - 1)
+    n_face = n_surface + 2 * (2 * (rows - 1) + 2 * (cols - 1))
+    if border:
+        n_face += FRAME_FACE_COUNT
+    faces = np.empty((n_face, 3), dtype=np.int32)
+    
+    if adaptive_mesh:
+        faces[:n_surface] = surface_faces
+    else:
+        build_surface_mesh(thicknesses, scale_x, scale_y, vertices, faces)
+    pbar.update()
+    face_offset = n_surface
     
     # Add side walls
     pbar.set_description("Adding side walls")
-    faces = create_side_walls(vertices, faces, rows, cols, rows * cols)
+    face_offset = create_side_walls(faces, face_offset, rows, cols, rows * cols)
+    pbar.update()
     
     # Add border if requested
     if border:
         pbar.set_description("Adding border frame")
-        vertices, faces = add_border_frame(vertices, faces, rows, cols, 
-                                         border_width, border_height, 
-                                         min_thickness, scale_x, scale_y)
-    
-    # Create the mesh
-    pbar.set_description("Finalizing mesh")
-    vertices = np.array(vertices)
-    faces = np.array(faces)
+        add_border_frame(vertices, faces, 2 * rows * cols, face_offset, rows, cols, 
+                         border_width, border_height, 
+                         min_thickness, scale_x, scale_y)
+        pbar.update()
     
-    model = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-    for i, face in enumerate(faces):
-        for j in range(3):
-            model.vectors[i][j] = vertices[face[j]]
+    # Merged quads leave interior grid vertices unused
+    if adaptive_mesh:
+        vertices, faces = remove_unused_vertices(vertices, faces)
     
-    pbar.set_description("Saving STL file")
-    try:
-        model.save(output_path)
-    except Exception as e:
-        raise RuntimeError(f"Failed to save STL file: {str(e)}")
+    if output_format == '3mf':
+        pbar.set_description("Saving 3MF file")
+        try:
+            output_path = save_3mf(output_path, vertices, faces)
+        except Exception as e:
+            raise RuntimeError(f"Failed to save 3MF file: {str(e)}")
+    else:
+        pbar.set_description("Saving STL file")
+        try:
+            save_binary_stl(output_path, vertices, faces)
+        except Exception as e:
+            raise RuntimeError(f"Failed to save STL file: {str(e)}")
+    pbar.update()
     
     pbar.close()
     
@@ -270,6 +257,9 @@ def create_lithophane(image_path, output_path, max_thickness=3.0, min_thickness=
     print(f"Thickness range: {min_thickness}mm to {max_thickness}mm")
     if border:
         print(f"Border added: {border_width}mm wide, {border_height}mm high")
+    if adaptive_mesh:
+        full_faces = 4 * (rows - 1) * (cols - 1) + n_face - n_surface
+        print(f"Adaptive mesh: {len(faces)} triangles ({100 * len(faces) / full_faces:.0f}% of full resolution)")
 
 
 def get_interactive_input():
@@ -290,6 +280,13 @@ def get_interactive_input():
         border_height = 5
     
     invert = input("Invert thickness mapping? (y/n, default: n): ").lower() == 'y'
+    output_format = input("Output format (stl/3mf/heightmap, default: stl): ").lower() or "stl"
+    adaptive_mesh = input("Merge flat regions to reduce triangle count? (y/n, default: n): ").lower() == 'y'
+    
+    if adaptive_mesh:
+        flat_tolerance = float(input("Enter flat tolerance in mm (or press Enter for default 0.01): ") or "0.01")
+    else:
+        flat_tolerance = 0.01
     
     return {
         'image_path': image_path,
@@ -301,7 +298,10 @@ def get_interactive_input():
         'border': border,
         'border_width': border_width,
         'border_height': border_height,
-        'invert': invert
+        'invert': invert,
+        'output_format': output_format,
+        'adaptive_mesh': adaptive_mesh,
+        'flat_tolerance': flat_tolerance
     }
 
 def main():
@@ -328,6 +328,12 @@ def main():
                           help='Border height in mm (default: 5)', default=5)
         parser.add_argument('--invert', action='store_true', 
                           help='Invert thickness mapping')
+        parser.add_argument('--format', choices=OUTPUT_FORMATS, 
+                          help='Output format (default: stl)', default='stl')
+        parser.add_argument('--adaptive-mesh', action='store_true', 
+                          help='Merge flat regions into larger quads to reduce triangle count')
+        parser.add_argument('--flat-tolerance', '-ft', type=float, 
+                          help='Thickness std. deviation in mm below which regions are merged (default: 0.01)', default=0.01)
 
         args = parser.parse_args()
         
@@ -342,7 +348,10 @@ def main():
                 border=args.border,
                 border_width=args.border_width,
                 border_height=args.border_height,
-                invert=args.invert
+                invert=args.invert,
+                output_format=args.format,
+                adaptive_mesh=args.adaptive_mesh,
+                flat_tolerance=args.flat_tolerance
             )
         except Exception as e:
             print(f"\nError: {str(e)}")